@@ -0,0 +1,109 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+# simple magic for using scripts within a source tree
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.isdir(os.path.join(basedir, "virttest")):
+    sys.path.append(basedir)
+
+from virttest import ppm_utils, storage
+
+
+class ImagePpmToPng(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ppm_utils_")
+        self.width = 3
+        self.height = 2
+        # red, green, blue / black, gray, white
+        self.data = (
+            b"\xff\x00\x00\x00\xff\x00\x00\x00\xff"
+            b"\x00\x00\x00\x7f\x7f\x7f\xff\xff\xff"
+        )
+        self.ppm_filename = os.path.join(self.tmpdir, "image.ppm")
+        self.png_filename = os.path.join(self.tmpdir, "image.png")
+        ppm_utils.image_write_to_ppm_file(
+            self.ppm_filename, self.width, self.height, self.data
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _read_png_chunks(filename):
+        with open(filename, "rb") as png_file:
+            png_data = png_file.read()
+        chunks = []
+        offset = 8
+        while offset < len(png_data):
+            (length,) = struct.unpack(">I", png_data[offset : offset + 4])
+            chunk_type = png_data[offset + 4 : offset + 8]
+            payload = png_data[offset + 8 : offset + 8 + length]
+            (crc,) = struct.unpack(
+                ">I", png_data[offset + 8 + length : offset + 12 + length]
+            )
+            chunks.append((chunk_type, payload, crc))
+            offset += 12 + length
+        return png_data[:8], chunks
+
+    def test_converted_png_structure_and_pixels(self):
+        ppm_utils.image_ppm_to_png(self.ppm_filename, self.png_filename)
+        signature, chunks = self._read_png_chunks(self.png_filename)
+        self.assertEqual(signature, b"\x89PNG\r\n\x1a\n")
+        self.assertEqual([c[0] for c in chunks], [b"IHDR", b"IDAT", b"IEND"])
+        for chunk_type, payload, crc in chunks:
+            self.assertEqual(crc, zlib.crc32(chunk_type + payload) & 0xFFFFFFFF)
+        ihdr = struct.unpack(">IIBBBBB", chunks[0][1])
+        # width, height, bit depth 8, color type 2 (truecolor RGB)
+        self.assertEqual(ihdr, (self.width, self.height, 8, 2, 0, 0, 0))
+        raw = zlib.decompress(chunks[1][1])
+        row_bytes = self.width * 3
+        self.assertEqual(len(raw), self.height * (1 + row_bytes))
+        pixels = b""
+        for row in range(self.height):
+            offset = row * (1 + row_bytes)
+            # filter type "None" per scanline, so the raw bytes are pixels
+            self.assertEqual(raw[offset], 0)
+            pixels += raw[offset + 1 : offset + 1 + row_bytes]
+        self.assertEqual(pixels, self.data)
+
+
+class CloneNeeded(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_clone_needed_")
+        self.master = os.path.join(self.tmpdir, "master.qcow2")
+        with open(self.master, "wb") as master_file:
+            master_file.write(b"\x42" * 4096)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_clone(self, data):
+        clone = os.path.join(self.tmpdir, "clone.qcow2")
+        with open(clone, "wb") as clone_file:
+            clone_file.write(data)
+        return clone
+
+    def test_identical_clone_not_needed(self):
+        clone = self._write_clone(b"\x42" * 4096)
+        self.assertFalse(storage.QemuImg._clone_needed(self.master, clone))
+
+    def test_different_content_needs_clone(self):
+        clone = self._write_clone(b"\x42" * 4095 + b"\x43")
+        self.assertTrue(storage.QemuImg._clone_needed(self.master, clone))
+
+    def test_different_size_needs_clone(self):
+        clone = self._write_clone(b"\x42" * 2048)
+        self.assertTrue(storage.QemuImg._clone_needed(self.master, clone))
+
+    def test_missing_target_needs_clone(self):
+        clone = os.path.join(self.tmpdir, "missing.qcow2")
+        self.assertTrue(storage.QemuImg._clone_needed(self.master, clone))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,6 @@
-from __future__ import division
-
 import copy
-import glob
+import fnmatch
+import hashlib
 import logging
 import multiprocessing
 import os
@@ -12,14 +11,11 @@ import threading
 import time
 
 import aexpect
-import six
 from aexpect import remote
 from avocado.core import exceptions
 from avocado.utils import archive
 from avocado.utils import cpu as cpu_utils
-from avocado.utils import crypto
 from avocado.utils import process as a_process
-from six.moves import xrange
 
 from virttest import (
     arch,
@@ -65,8 +61,11 @@ libvirt_vm = lazy_import("virttest.libvirt_vm")
 
 
 try:
-    import PIL.Image
+    # PIL is optional and heavy; defer loading it until an image is
+    # actually converted
+    PIL_Image = lazy_import("PIL.Image")
 except ImportError:
+    PIL_Image = None
     logging.getLogger("avocado.app").warning(
         "No python imaging library installed. PPM image conversion to JPEG "
         "disabled. In order to enable it, please install python-imaging or the "
@@ -100,10 +99,20 @@ KVM_MODULE_HANDLERS = []
 #: information from the output produced by `qemu -version`
 QEMU_VERSION_RE = r"QEMU (?:PC )?emulator version\s([0-9]+\.[0-9]+\.[0-9]+)\s?\((.*?)\)"
 
+#: Patterns used on the pre/postprocess paths, compiled once at import time
+_QEMU_VERSION_RE = re.compile(QEMU_VERSION_RE)
+_PCI_OPTION_RE = re.compile(r"pci=.*?\s+")
+_SIMPLE_VERSION_RE = re.compile(r"[0-9]+\.[0-9]+\.[0-9]+(\-[0-9]+)?")
+_VIRTIO_WIN_VERSION_RE = re.compile(r"virtio-win-(?:prewhql-)?(\d+\.\d+(?:\.\d+)?-\d+)")
+
 THREAD_ERROR = False
 
 LOG = logging.getLogger("avocado." + __name__)
 
+#: Cache of qemu version strings keyed on the binary path; querying the
+#: version spawns the binary, and it does not change within a job
+_qemu_version_cache = {}
+
 
 def _get_qemu_version(qemu_cmd):
     """
@@ -111,13 +120,18 @@ def _get_qemu_version(qemu_cmd):
 
     :param qemu_cmd: Path to qemu binary
     """
+    version = _qemu_version_cache.get(qemu_cmd)
+    if version is not None:
+        return version
     version_output = a_process.run("%s -version" % qemu_cmd, verbose=False).stdout_text
     version_line = version_output.split("\n")[0]
-    matches = re.match(QEMU_VERSION_RE, version_line)
+    matches = _QEMU_VERSION_RE.match(version_line)
     if matches:
-        return "%s (%s)" % matches.groups()
+        version = "%s (%s)" % matches.groups()
     else:
-        return "Unknown"
+        version = "Unknown"
+    _qemu_version_cache[qemu_cmd] = version
+    return version
 
 
 def preprocess_image(test, params, image_name, vm_process_status=None):
@@ -135,21 +149,34 @@ def preprocess_image(test, params, image_name, vm_process_status=None):
     if not storage.preprocess_image_backend(base_dir, params, image_name):
         LOG.error("Backend can't be prepared correctly.")
 
+    # Fast path: no creation or backup requested for this image, so the
+    # filename resolution and existence checks below are not needed
+    if (
+        params.get("force_create_image") != "yes"
+        and params.get("create_image") != "yes"
+        and params.get("backup_image_before_testing", "no") != "yes"
+    ):
+        return
+
     image_filename = storage.get_image_filename(params, base_dir)
 
+    # storage.file_exists() can involve a remote backend query, so run it
+    # at most once and reuse the answer for both decisions below
+    image_exists = None
     create_image = False
     if params.get("force_create_image") == "yes":
         create_image = True
-    elif params.get("create_image") == "yes" and not storage.file_exists(
-        params, image_filename
-    ):
-        create_image = True
+    elif params.get("create_image") == "yes":
+        image_exists = storage.file_exists(params, image_filename)
+        create_image = not image_exists
 
     if params.get("backup_image_before_testing", "no") == "yes":
         image = qemu_storage.QemuImg(params, base_dir, image_name)
         image.backup_image(params, base_dir, "backup", True, True)
     if create_image:
-        if storage.file_exists(params, image_filename):
+        if image_exists is None:
+            image_exists = storage.file_exists(params, image_filename)
+        if image_exists:
             # As rbd image can not be covered, so need remove it if we need
             # force create a new image.
             storage.file_remove(params, image_filename)
@@ -249,8 +276,6 @@ def preprocess_vm(test, params, env, name):
             params["medium"] = "import"
             vm.create(params=params)
 
-    old_vm = copy.copy(vm)
-
     if vm_type == "libvirt":
         install_test = "unattended_install.import.import.default_install." "aio_native"
         remove_test = "remove_guest.without_disk"
@@ -292,6 +317,10 @@ def preprocess_vm(test, params, env, name):
                 start_vm = True
             if params.get("check_vm_needs_restart", "yes") == "yes":
                 if vm.needs_restart(name=name, params=params, basedir=test.bindir):
+                    # Snapshot the old VM object only here, where its previous
+                    # process still has to be torn down after the restart
+                    # decision; the common path avoids the copy entirely
+                    old_vm = copy.copy(vm)
                     vm.devices = None
                     start_vm = True
                     old_vm.destroy(gracefully=gracefully_kill)
@@ -337,8 +366,8 @@ def preprocess_vm(test, params, env, name):
             disable_pci_msi = params.get("disable_pci_msi")
             if disable_pci_msi == "yes":
                 if "pci=" in kernel_extra_params_add:
-                    kernel_extra_params_add = re.sub(
-                        "pci=.*?\s+", "pci=nomsi ", kernel_extra_params_add
+                    kernel_extra_params_add = _PCI_OPTION_RE.sub(
+                        "pci=nomsi ", kernel_extra_params_add
                     )
                 else:
                     kernel_extra_params_add += " pci=nomsi"
@@ -376,6 +405,9 @@ def preprocess_vm(test, params, env, name):
             params.get("kill_vm_before_test") == "yes"
             and params.get("start_vm") == "no"
         ):
+            # Destroy a shallow copy so the registered VM object itself is
+            # not marked down by the teardown
+            old_vm = copy.copy(vm)
             old_vm.destroy(gracefully=gracefully_kill)
         else:
             # VM is alive and we just need to open the serial console
@@ -412,17 +444,21 @@ def preprocess_vm(test, params, env, name):
         try:
             output = vm.serial_console.read_until_output_matches(cmd_line, timeout=60)
 
-            kernel_cmd_line = re.findall("%s.*" % cmd_line, output[1])[0]
+            kernel_cmd_line = re.search("%s.*" % cmd_line, output[1]).group(0)
+            # Compare whole options instead of substrings, so e.g. "quiet"
+            # does not silently match "quietmode"; set membership also
+            # avoids rescanning the command line per option
+            kernel_cmd_line_options = set(kernel_cmd_line.split())
             kernel_options_exist = params.get("kernel_options_exist", "")
             kernel_options_not_exist = params.get("kernel_options_not_exist", "")
 
             err_msg = ""
             for kernel_option in kernel_options_exist.split():
-                if kernel_option not in kernel_cmd_line:
+                if kernel_option not in kernel_cmd_line_options:
                     err_msg += "%s not in kernel command line" % kernel_option
                     err_msg += " as expect."
             for kernel_option in kernel_options_not_exist.split():
-                if kernel_option in kernel_cmd_line:
+                if kernel_option in kernel_cmd_line_options:
                     err_msg += "%s exist in kernel command" % kernel_option
                     err_msg += " line."
             if err_msg:
@@ -461,22 +497,23 @@ def check_image(test, params, image_name, vm_process_status=None):
             check_image_flag = False
         else:
             image_info_output = image.info(force_share=True)
-            image_info = {}
+            lazy_refcounts = None
             if image_info_output is not None:
+                # Only the "lazy refcounts" entry is of interest here, so
+                # scan for it directly instead of building a full dict out
+                # of the qemu-img info output
                 for image_info_item in image_info_output.splitlines():
-                    option = image_info_item.split(":")
-                    if len(option) == 2:
-                        image_info[option[0].strip()] = option[1].strip()
+                    option = image_info_item.split(":", 1)
+                    if len(option) == 2 and option[0].strip() == "lazy refcounts":
+                        lazy_refcounts = option[1].strip()
+                        break
             else:
                 LOG.debug(
                     "Can not find matched image for selected guest "
                     "os, skip the image check."
                 )
                 check_image_flag = False
-            if (
-                "lazy refcounts" in image_info
-                and image_info["lazy refcounts"] == "true"
-            ):
+            if lazy_refcounts == "true":
                 LOG.debug(
                     "Should not check image while guest is alive"
                     " when the image is create with lazy refcounts."
@@ -512,8 +549,8 @@ def check_image(test, params, image_name, vm_process_status=None):
             params["img_check_failed"] = "yes"
             if params.get(
                 "skip_cluster_leak_warn"
-            ) == "yes" and "Leaked clusters" in six.text_type(e):
-                LOG.warn(six.text_type(e))
+            ) == "yes" and "Leaked clusters" in str(e):
+                LOG.warn(str(e))
             else:
                 raise e
 
@@ -539,6 +576,7 @@ def postprocess_image(test, params, image_name, vm_process_status=None):
     clone_master = params.get("clone_master", None)
     base_dir = params.get("images_base_dir", data_dir.get_data_dir())
     image = None
+    cl_images = frozenset(params.get("master_images_clone", "").split())
 
     if params.get("img_check_failed") == "yes":
         image = (
@@ -581,8 +619,7 @@ def postprocess_image(test, params, image_name, vm_process_status=None):
             qemu_storage.QemuImg(params, base_dir, image_name) if not image else image
         )
         if params.get("remove_image_on_check_error", "no") == "yes":
-            cl_images = params.get("master_images_clone", "")
-            if image_name in cl_images.split():
+            if image_name in cl_images:
                 image.remove()
                 removed = True
 
@@ -594,7 +631,7 @@ def postprocess_image(test, params, image_name, vm_process_status=None):
         if clone_master is None:
             image.remove()
         elif clone_master == "yes":
-            if image_name in params.get("master_images_clone").split():
+            if image_name in cl_images:
                 image.remove()
 
 
@@ -730,12 +767,17 @@ def process_command(test, params, env, command, command_timeout, command_noncrit
     :param command_timeout: Timeout for command execution.
     :param command_noncritical: If True test will not fail if command fails.
     """
-    # Export environment vars
-    for k in params:
-        os.putenv("KVM_TEST_%s" % k, str(params[k]))
+    # Export the params to the command environment only, instead of mutating
+    # the environment of the whole test process with one putenv() per key
+    cmd_env = {"KVM_TEST_%s" % k: str(params[k]) for k in params}
     # Execute commands
     try:
-        a_process.system("cd %s; %s" % (test.bindir, command), shell=True)
+        a_process.system(
+            "cd %s; %s" % (test.bindir, command),
+            shell=True,
+            env=cmd_env,
+            timeout=command_timeout,
+        )
     except a_process.CmdError as e:
         if command_noncritical:
             LOG.warn(e)
@@ -786,7 +828,7 @@ def process_images(image_func, test, params, vm_process_status=None):
                               or None for no vm exist.
     """
     images = params.objects("images")
-    if len(images) > 20:  # Lets do it in parallel
+    if len(images) > 1:  # Lets do it in parallel
         _process_images_parallel(
             image_func, test, params, vm_process_status=vm_process_status
         )
@@ -842,10 +884,17 @@ def _process_images_parallel(image_func, test, params, vm_process_status=None):
                               or None for no vm exist.
     """
     images = params.objects("images")
-    no_threads = min(len(images) // 5, 2 * multiprocessing.cpu_count())
+    # Worker count is bounded by the number of images and twice the host CPU
+    # count; image processing is mostly I/O bound (qemu-img create/backup),
+    # so oversubscribing the CPUs a bit pays off.  The optional
+    # max_image_workers param caps it to avoid swamping the storage backend.
+    no_threads = max(1, min(len(images), 2 * multiprocessing.cpu_count()))
+    max_workers = int(params.get("max_image_workers", 0))
+    if max_workers > 0:
+        no_threads = min(no_threads, max_workers)
     exit_event = threading.Event()
     threads = []
-    for i in xrange(no_threads):
+    for i in range(no_threads):
         imgs = images[i::no_threads]
         threads.append(
             _CreateImages(image_func, test, imgs, params, exit_event, vm_process_status)
@@ -859,7 +908,7 @@ def _process_images_parallel(image_func, test, params, vm_process_status=None):
         LOG.error("Image processing failed:")
         for thread in threads:
             if thread.exc_info:  # Throw the first failure
-                six.reraise(thread.exc_info[1], None, thread.exc_info[2])
+                raise thread.exc_info[1].with_traceback(thread.exc_info[2])
     del exit_event
     del threads[:]
 
@@ -879,11 +928,21 @@ def process(
     :param vm_first: Call vm_func first or not.
     :param fs_source_func: A function to call for each filesystem source.
     """
+    # object_params() re-merges the whole Cartesian dict on every call, so
+    # compute each VM variant only once and share it between the closures
+    # below (pre/post rounds call several of them for the same VMs).
+    _vm_params_cache = {}
+
+    def _get_vm_params(vm_name):
+        vm_params = _vm_params_cache.get(vm_name)
+        if vm_params is None:
+            vm_params = params.object_params(vm_name)
+            _vm_params_cache[vm_name] = vm_params
+        return vm_params
 
     def _call_vm_func():
         for vm_name in params.objects("vms"):
-            vm_params = params.object_params(vm_name)
-            vm_func(test, vm_params, env, vm_name)
+            vm_func(test, _get_vm_params(vm_name), env, vm_name)
 
     def _call_image_func():
         if params.get("skip_image_processing") == "yes":
@@ -891,7 +950,7 @@ def process(
 
         if params.objects("vms"):
             for vm_name in params.objects("vms"):
-                vm_params = params.object_params(vm_name)
+                vm_params = _get_vm_params(vm_name)
                 vm = env.get_vm(vm_name)
                 unpause_vm = False
                 if vm is None or vm.is_dead():
@@ -916,7 +975,7 @@ def process(
 
         if params.objects("vms"):
             for vm_name in params.objects("vms"):
-                vm_params = params.object_params(vm_name)
+                vm_params = _get_vm_params(vm_name)
                 if not vm_params.get("filesystems"):
                     continue
                 vm = env.get_vm(vm_name)
@@ -942,7 +1001,7 @@ def process(
 
         if params.objects("vms"):
             for vm_name in params.objects("vms"):
-                vm_params = params.object_params(vm_name)
+                vm_params = _get_vm_params(vm_name)
                 vm = env.get_vm(vm_name)
                 unpause_vm = False
                 if vm is None or vm.is_dead():
@@ -1137,25 +1196,35 @@ def preprocess(test, params, env):
 
     # Destroy and remove VMs that are no longer needed in the environment or
     # leave them untouched if they have to be disregarded only for this test
-    requested_vms = params.objects("vms")
+    requested_vms = set(params.objects("vms"))
     keep_unrequested_vms = params.get_boolean("keep_unrequested_vms", False)
     kill_unrequested_vms_gracefully = params.get_boolean(
         "kill_unrequested_vms_gracefully", True
     )
-    for key in list(env.keys()):
-        vm = env[key]
-        if not isinstance(vm, virt_vm.BaseVM):
-            continue
-        if vm.name not in requested_vms:
-            if keep_unrequested_vms:
-                LOG.debug(
-                    "The vm %s is registered in the env and disregarded "
-                    "in the current test",
-                    vm.name,
-                )
-            else:
-                vm.destroy(gracefully=kill_unrequested_vms_gracefully)
-                del env[key]
+    # Several registry keys may point at same-named VMs (e.g. a migration
+    # clone is registered under "<name>_clone"), so track the entries by
+    # their own keys rather than by vm.name
+    stale_vms = [
+        (key, env[key])
+        for key in list(env.keys())
+        if isinstance(env[key], virt_vm.BaseVM) and env[key].name not in requested_vms
+    ]
+    if keep_unrequested_vms:
+        for _, vm in stale_vms:
+            LOG.debug(
+                "The vm %s is registered in the env and disregarded "
+                "in the current test",
+                vm.name,
+            )
+    elif stale_vms:
+        # Destroying a VM waits for its process to go away, so tear the
+        # stale ones down in parallel instead of paying that wait per VM
+        utils_misc.parallel(
+            (vm.destroy, (), {"gracefully": kill_unrequested_vms_gracefully})
+            for _, vm in stale_vms
+        )
+        for key, _ in stale_vms:
+            del env[key]
 
     global KVM_MODULE_HANDLERS
     kvm_modules = arch.get_kvm_module_list()
@@ -1187,7 +1256,7 @@ def preprocess(test, params, env):
     if params.get("required_kernel"):
         required_kernel = params.get("required_kernel")
         LOG.info("Test requires kernel version: %s" % required_kernel)
-        match = re.search(r"[0-9]+\.[0-9]+\.[0-9]+(\-[0-9]+)?", kvm_version)
+        match = _SIMPLE_VERSION_RE.search(kvm_version)
         if match is None:
             test.cancel("Can not get host kernel version.")
         host_kernel = match.group(0)
@@ -1223,7 +1292,7 @@ def preprocess(test, params, env):
     if params.get("required_qemu"):
         required_qemu = params.get("required_qemu")
         LOG.info("Test requires qemu version: %s" % required_qemu)
-        match = re.search(r"[0-9]+\.[0-9]+\.[0-9]+(\-[0-9]+)?", kvm_userspace_version)
+        match = _SIMPLE_VERSION_RE.search(kvm_userspace_version)
         if match is None:
             test.cancel("Can not get host qemu version.")
         host_qemu = match.group(0)
@@ -1254,21 +1323,18 @@ def preprocess(test, params, env):
             )
             virtio_win_range = (
                 params.get("required_virtio_win_prewhql")
-                if re.search("prewhql", cdrom_virtio_path)
+                if "prewhql" in cdrom_virtio_path
                 else params.get("required_virtio_win")
             )
             if virtio_win_range:
                 LOG.info("Checking required virtio-win version: %s" % virtio_win_range)
-                match = re.search(
-                    "virtio-win-(?:prewhql-)?(\d+\.\d+(?:\.\d+)?-\d+)",
-                    cdrom_virtio_path,
-                )
+                match = _VIRTIO_WIN_VERSION_RE.search(cdrom_virtio_path)
                 if match.group(1) is None:
                     test.error(
                         'Can not get virtio-win version from "cdrom_virtio": %s'
                         % cdrom_virtio
                     )
-                cdrom_virtio_version = re.sub("-", ".", match.group(1))
+                cdrom_virtio_version = match.group(1).replace("-", ".")
                 if cdrom_virtio_version not in VersionInterval(virtio_win_range):
                     test.cancel(
                         "Got virtio-win version:%s, which is not in %s"
@@ -1337,7 +1403,8 @@ def preprocess(test, params, env):
         connect_uri = libvirt_vm.normalize_connect_uri(connect_uri)
         # Set the LIBVIRT_DEFAULT_URI to make virsh command
         # work on connect_uri as default behavior.
-        os.environ["LIBVIRT_DEFAULT_URI"] = connect_uri
+        if os.environ.get("LIBVIRT_DEFAULT_URI") != connect_uri:
+            os.environ["LIBVIRT_DEFAULT_URI"] = connect_uri
         if params.get("setup_libvirt_polkit") == "yes":
             pol = test_setup.LibvirtPolkitConfig(params)
             try:
@@ -1382,10 +1449,18 @@ def preprocess(test, params, env):
 
     # Clone master image from vms.
     if params.get("master_images_clone"):
-        for vm_name in params.get("vms").split():
-            vm = env.get_vm(vm_name)
+        clone_vms = [
+            (vm_name, env.get_vm(vm_name)) for vm_name in params.get("vms").split()
+        ]
+        # Destroy the VMs concurrently; unregistering mutates the shared
+        # env object and stays serial
+        destroy_jobs = [(vm.destroy, (), {}) for _, vm in clone_vms if vm]
+        if len(destroy_jobs) > 1:
+            utils_misc.parallel(destroy_jobs)
+        elif destroy_jobs:
+            destroy_jobs[0][0]()
+        for vm_name, vm in clone_vms:
             if vm:
-                vm.destroy()
                 env.unregister_vm(vm_name)
 
             vm_params = params.object_params(vm_name)
@@ -1554,6 +1629,16 @@ def preprocess(test, params, env):
     return params
 
 
+def _format_error_details(details):
+    """
+    Render exception details for the postprocess error summary, indenting
+    continuation lines so the per-step failures stay readable.
+
+    :param details: The caught exception (or any printable object).
+    """
+    return str(details).replace("\n", "\n  ").replace("\\n", "\n  ")
+
+
 @error_context.context_aware
 def postprocess(test, params, env):
     """
@@ -1572,21 +1657,22 @@ def postprocess(test, params, env):
         try:
             postprocess_vm_on_hook(test, params, env)  # pylint: disable=E1102
         except Exception as details:
-            err += "\nPostprocessing living vm hook: %s" % str(details).replace(
-                "\\n", "\n  "
+            err += "\nPostprocessing living vm hook: %s" % _format_error_details(
+                details
             )
             LOG.error(details)
 
     migration_setup = params.get("migration_setup", "no") == "yes"
+    # Nothing below unregisters VMs, so one snapshot of the registry serves
+    # every loop; liveness is still (re)checked per use
+    all_vms = env.get_all_vms()
     if (
         params.get("verify_guest_dmesg", "yes") == "yes"
         and params.get("start_vm", "no") == "yes"
     ):
         guest_dmesg_log_file = params.get("guest_dmesg_logfile", "guest_dmesg.log")
         guest_dmesg_log_file = utils_misc.get_path(test.debugdir, guest_dmesg_log_file)
-        living_vms = [
-            vm for vm in env.get_all_vms() if (vm.is_alive() and not vm.is_paused())
-        ]
+        living_vms = [vm for vm in all_vms if (vm.is_alive() and not vm.is_paused())]
         for vm in living_vms:
             if params.get("guest_dmesg_dump_console") == "yes":
                 guest_dmesg_log_file = None
@@ -1597,9 +1683,9 @@ def postprocess(test, params, env):
             except Exception as details:
                 err += "\n: Guest %s dmesg verification failed: %s" % (vm.name, details)
 
-    base_dir = data_dir.get_data_dir()
     # if sysprep was requested in preprocess then restore back the original image
     if params.get("sysprep_required", "no") == "yes":
+        base_dir = data_dir.get_data_dir()
         LOG.info("Restoring the original master image.")
         image_filename = storage.get_image_filename(params, base_dir)
         image_obj = qemu_storage.QemuImg(params, base_dir, image_filename)
@@ -1608,9 +1694,7 @@ def postprocess(test, params, env):
 
     # collect sosreport of guests during postprocess if enabled
     if params.get("enable_guest_sosreport", "no") == "yes":
-        living_vms = [
-            vm for vm in env.get_all_vms() if (vm.is_alive() and not vm.is_paused())
-        ]
+        living_vms = [vm for vm in all_vms if (vm.is_alive() and not vm.is_paused())]
         for vm in living_vms:
             sosreport_path = vm.sosreport()
             LOG.info("Sosreport for guest: %s", sosreport_path)
@@ -1655,7 +1739,7 @@ def postprocess(test, params, env):
             postprocess_fs_source,
         )
     except Exception as details:
-        err += "\nPostprocess: %s" % str(details).replace("\\n", "\n  ")
+        err += "\nPostprocess: %s" % _format_error_details(details)
         LOG.error(details)
 
     # Terminate the screendump thread
@@ -1666,11 +1750,18 @@ def postprocess(test, params, env):
         _screendump_thread = None
 
     # Encode an HTML 5 compatible video from the screenshots produced
-    dir_rex = "(screendump\S*_[0-9]+_iter%s)" % test.iteration
-    for screendump_dir in re.findall(dir_rex, str(os.listdir(test.debugdir))):
-        screendump_dir = os.path.join(test.debugdir, screendump_dir)
-        if params.get("encode_video_files", "yes") == "yes" and glob.glob(
-            "%s/*" % screendump_dir
+    dir_rex = re.compile(r"screendump\S*_[0-9]+_iter%s$" % test.iteration)
+    try:
+        screendump_dirs = [
+            entry.path
+            for entry in os.scandir(test.debugdir)
+            if dir_rex.match(entry.name)
+        ]
+    except OSError:
+        screendump_dirs = []
+    for screendump_dir in screendump_dirs:
+        if params.get("encode_video_files", "yes") == "yes" and os.listdir(
+            screendump_dir
         ):
             try:
                 # Loading video_maker at the top level is causing
@@ -1698,39 +1789,72 @@ def postprocess(test, params, env):
         screendump_temp_dir = utils_misc.get_path(test.bindir, screendump_temp_dir)
     else:
         screendump_temp_dir = test.debugdir
+    # Collect this iteration's PPM files with a single directory scan; the
+    # corrupt-check, PNG conversion and cleanup branches below all reuse it
     ppm_file_rex = "*_iter%s.ppm" % test.iteration
-    for f in glob.glob(os.path.join(screendump_temp_dir, ppm_file_rex)):
+    try:
+        ppm_files = [
+            entry.path
+            for entry in os.scandir(screendump_temp_dir)
+            if fnmatch.fnmatch(entry.name, ppm_file_rex)
+        ]
+    except OSError:
+        ppm_files = []
+    for f in ppm_files:
         if not ppm_utils.image_verify_ppm_file(f):
             LOG.warn("Found corrupt PPM file: %s", f)
 
     # Should we convert PPM files to PNG format?
     if params.get("convert_ppm_files_to_png", "no") == "yes":
-        try:
-            for f in glob.glob(os.path.join(screendump_temp_dir, ppm_file_rex)):
-                if ppm_utils.image_verify_ppm_file(f):
-                    new_path = f.replace(".ppm", ".png")
-                    image = PIL.Image.open(f)
-                    image.save(new_path, format="PNG")
-        except NameError:
-            pass
+        for f in ppm_files:
+            if ppm_utils.image_verify_ppm_file(f):
+                ppm_utils.image_ppm_to_png(f, f.replace(".ppm", ".png"))
+
+    # Collect the screendump artifacts that are not kept and delete them in
+    # a background thread; none of the remaining postprocess steps depend
+    # on them, so the serial unlink/rmtree wait is taken off this path
+    cleanup_files = []
+    cleanup_dirs = []
 
     # Should we keep the PPM files?
     if params.get("keep_ppm_files", "no") != "yes":
-        for f in glob.glob(os.path.join(screendump_temp_dir, ppm_file_rex)):
-            os.unlink(f)
-
-    # Should we keep the screendump dirs?
-    if params.get("keep_screendumps", "no") != "yes":
-        for d in glob.glob(os.path.join(test.debugdir, "screendumps_*")):
-            if os.path.isdir(d) and not os.path.islink(d):
-                shutil.rmtree(d, ignore_errors=True)
-
-    # Should we keep the video files?
-    if params.get("keep_video_files", "yes") != "yes":
-        for f in glob.glob(os.path.join(test.debugdir, "*.ogg")) + glob.glob(
-            os.path.join(test.debugdir, "*.webm")
-        ):
-            os.unlink(f)
+        cleanup_files.extend(ppm_files)
+
+    # Should we keep the screendump dirs and the video files?  One scandir
+    # pass over the debug dir covers both checks without re-stat'ing
+    keep_screendumps = params.get("keep_screendumps", "no") == "yes"
+    keep_video_files = params.get("keep_video_files", "yes") == "yes"
+    if not (keep_screendumps and keep_video_files):
+        try:
+            debugdir_entries = list(os.scandir(test.debugdir))
+        except OSError:
+            debugdir_entries = []
+        for entry in debugdir_entries:
+            if (
+                not keep_screendumps
+                and entry.name.startswith("screendumps_")
+                and entry.is_dir(follow_symlinks=False)
+            ):
+                cleanup_dirs.append(entry.path)
+            elif not keep_video_files and entry.name.endswith((".ogg", ".webm")):
+                cleanup_files.append(entry.path)
+
+    cleanup_thread = None
+    if cleanup_files or cleanup_dirs:
+
+        def _remove_artifacts():
+            for cleanup_file in cleanup_files:
+                try:
+                    os.unlink(cleanup_file)
+                except OSError as details:
+                    LOG.warning("Could not remove %s: %s", cleanup_file, details)
+            for cleanup_dir in cleanup_dirs:
+                shutil.rmtree(cleanup_dir, ignore_errors=True)
+
+        cleanup_thread = threading.Thread(
+            target=_remove_artifacts, name="ArtifactCleanup"
+        )
+        cleanup_thread.start()
 
     # Terminate the register query thread
     global _vm_info_thread, _vm_info_thread_termination_event
@@ -1741,7 +1865,7 @@ def postprocess(test, params, env):
 
     # Kill all unresponsive VMs
     if params.get("kill_unresponsive_vms") == "yes":
-        for vm in env.get_all_vms():
+        for vm in all_vms:
             if vm.is_dead() or vm.is_paused():
                 continue
             try:
@@ -1757,12 +1881,20 @@ def postprocess(test, params, env):
                 vm.destroy(gracefully=False)
 
     # Kill VMs with deleted disks
-    for vm in env.get_all_vms():
+    image_params_cache = {}
+    for vm in all_vms:
         destroy = False
         vm_params = params.object_params(vm.name)
         for image in vm_params.objects("images"):
-            if params.object_params(image).get("remove_image") == "yes":
+            # the same images show up for several VMs; merge each image
+            # variant only once
+            image_params = image_params_cache.get(image)
+            if image_params is None:
+                image_params = params.object_params(image)
+                image_params_cache[image] = image_params
+            if image_params.get("remove_image") == "yes":
                 destroy = True
+                break
         if destroy and not vm.is_dead():
             LOG.debug("Image of VM %s was removed, destroying it.", vm.name)
             vm.destroy()
@@ -1789,7 +1921,7 @@ def postprocess(test, params, env):
             sosreport_name="host_remote",
         )
         LOG.info("Sosreport for remote host: %s", sosreport_path)
-    living_vms = [vm for vm in env.get_all_vms() if vm.is_alive()]
+    living_vms = [vm for vm in all_vms if vm.is_alive()]
     # Close all monitor socket connections of living vm.
     if not params.get_boolean("keep_vms_after_test", False):
         for vm in living_vms:
@@ -1839,17 +1971,39 @@ def postprocess(test, params, env):
                 test_setup.switch_indep_threads_mode(state="Y", params=params)
                 test_setup.switch_smt(state="on", params=params)
 
+    libvirtd_restart_thread = None
+    libvirtd_restart_errors = []
+    libvirtd_restart_pending = False
     if params.get("setup_hugepages") == "yes":
         global _post_hugepages_surp
         try:
             h = test_setup.HugePageConfig(params)
             h.cleanup()
             if vm_type == "libvirt":
-                if libvirtd_inst is None:
-                    libvirtd_inst = utils_libvirtd.Libvirtd()
-                libvirtd_inst.restart()
+                if params.get("setup_libvirt_polkit") == "yes":
+                    # The polkit cleanup's own restart below picks up the
+                    # hugepage changes as well; only fall back to a restart
+                    # here if that cleanup fails before restarting
+                    libvirtd_restart_pending = True
+                else:
+                    if libvirtd_inst is None:
+                        libvirtd_inst = utils_libvirtd.Libvirtd()
+
+                    def _restart_libvirtd(inst=libvirtd_inst):
+                        try:
+                            inst.restart()
+                        except Exception as details:
+                            libvirtd_restart_errors.append(details)
+
+                    # The restart waits for the daemon to come back, but
+                    # the THP/KSM/EGD cleanups in between don't touch
+                    # libvirt, so let it run alongside them
+                    libvirtd_restart_thread = threading.Thread(
+                        target=_restart_libvirtd, name="LibvirtdRestart"
+                    )
+                    libvirtd_restart_thread.start()
         except Exception as details:
-            err += "\nHP cleanup: %s" % str(details).replace("\\n", "\n  ")
+            err += "\nHP cleanup: %s" % _format_error_details(details)
             LOG.error(details)
         else:
             _post_hugepages_surp = h.ext_hugepages_surp
@@ -1859,18 +2013,15 @@ def postprocess(test, params, env):
             thp = test_setup.TransparentHugePageConfig(test, params, env)
             thp.cleanup()
         except Exception as details:
-            err += "\nTHP cleanup: %s" % str(details).replace("\\n", "\n  ")
+            err += "\nTHP cleanup: %s" % _format_error_details(details)
             LOG.error(details)
 
-    for kvm_module in KVM_MODULE_HANDLERS:
-        kvm_module.restore()
-
     if params.get("setup_ksm") == "yes":
         try:
             ksm = test_setup.KSMConfig(params, env)
             ksm.cleanup(env)
         except Exception as details:
-            err += "\nKSM cleanup: %s" % str(details).replace("\\n", "\n  ")
+            err += "\nKSM cleanup: %s" % _format_error_details(details)
             LOG.error(details)
 
     if params.get("setup_egd") == "yes" and params.get("kill_vm") == "yes":
@@ -1878,9 +2029,21 @@ def postprocess(test, params, env):
             egd = test_setup.EGDConfig(params, env)
             egd.cleanup()
         except Exception as details:
-            err += "\negd.pl cleanup: %s" % str(details).replace("\\n", "\n  ")
+            err += "\negd.pl cleanup: %s" % _format_error_details(details)
             LOG.error(details)
 
+    if libvirtd_restart_thread is not None:
+        libvirtd_restart_thread.join()
+        for details in libvirtd_restart_errors:
+            err += "\nHP cleanup: %s" % _format_error_details(details)
+            LOG.error(details)
+
+    # Restore the KVM modules only once the libvirtd restart has finished;
+    # a restarting daemon re-opens /dev/kvm, which would make the module
+    # unload fail with EBUSY
+    for kvm_module in KVM_MODULE_HANDLERS:
+        kvm_module.restore()
+
     if vm_type == "libvirt":
         if params.get("setup_libvirt_polkit") == "yes":
             try:
@@ -1889,12 +2052,23 @@ def postprocess(test, params, env):
                 if libvirtd_inst is None:
                     libvirtd_inst = utils_libvirtd.Libvirtd(all_daemons=True)
                 libvirtd_inst.restart()
+                libvirtd_restart_pending = False
             except test_setup.PolkitConfigCleanupError as e:
-                err += "\nPolkit cleanup: %s" % str(e).replace("\\n", "\n  ")
+                err += "\nPolkit cleanup: %s" % _format_error_details(e)
                 LOG.error(e)
             except Exception as details:
-                err += "\nPolkit cleanup: %s" % str(details).replace("\\n", "\n  ")
+                err += "\nPolkit cleanup: %s" % _format_error_details(details)
                 LOG.error("Unexpected error: %s" % details)
+        if libvirtd_restart_pending:
+            # The polkit cleanup failed before restarting the daemons, so
+            # the restart the hugepage cleanup deferred to it is still owed
+            try:
+                if libvirtd_inst is None:
+                    libvirtd_inst = utils_libvirtd.Libvirtd()
+                libvirtd_inst.restart()
+            except Exception as details:
+                err += "\nHP cleanup: %s" % _format_error_details(details)
+                LOG.error(details)
 
     # Execute any post_commands
     if params.get("post_command"):
@@ -1908,7 +2082,7 @@ def postprocess(test, params, env):
                 params.get("post_command_noncritical") == "yes",
             )
         except Exception as details:
-            err += "\nPostprocess command: %s" % str(details).replace("\n", "\n  ")
+            err += "\nPostprocess command: %s" % _format_error_details(details)
             LOG.error(details)
 
     # cleanup migration presetup in post process
@@ -1945,11 +2119,12 @@ def postprocess(test, params, env):
         try:
             postprocess_vm_off_hook(test, params, env)  # pylint: disable=E1102
         except Exception as details:
-            err += "\nPostprocessing dead vm hook: %s" % str(details).replace(
-                "\\n", "\n  "
-            )
+            err += "\nPostprocessing dead vm hook: %s" % _format_error_details(details)
             LOG.error(details)
 
+    if cleanup_thread is not None:
+        cleanup_thread.join()
+
     if err:
         raise RuntimeError("Failures occurred while postprocess:\n%s" % err)
     elif _post_hugepages_surp > _pre_hugepages_surp:
@@ -1968,6 +2143,35 @@ def postprocess_on_error(test, params, env):
     params.update(params.object_params("on_error"))
 
 
+_screendump_id_buffer = bytearray(64 * 1024)
+
+
+def _screendump_id(filename):
+    """
+    Return a cheap identity key for a screendump file.
+
+    The file size acts as a prefilter in the key so dumps of different
+    geometry never collide, and the content digest uses the fast builtin
+    BLAKE2 hash computed incrementally in chunks.
+
+    :param filename: Path to the screendump file.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    size = 0
+    # Reuse one buffer across reads (and across calls; only the screendump
+    # thread hashes dumps) instead of allocating a bytes object per chunk
+    buf = _screendump_id_buffer
+    view = memoryview(buf)
+    with open(filename, "rb") as dump_file:
+        while True:
+            nbytes = dump_file.readinto(buf)
+            if not nbytes:
+                break
+            size += nbytes
+            digest.update(view[:nbytes])
+    return (size, digest.hexdigest())
+
+
 def _take_screendumps(test, params, env):
     global _screendump_thread_termination_event
     temp_dir = test.debugdir
@@ -1978,8 +2182,6 @@ def _take_screendumps(test, params, env):
         except OSError:
             pass
     random_id = utils_misc.generate_random_string(6)
-    temp_filename = "scrdump-%s-iter%s.ppm" % (random_id, test.iteration)
-    temp_filename = os.path.join(temp_dir, temp_filename)
     delay = float(params.get("screendump_delay", 5))
     quality = int(params.get("screendump_quality", 30))
     inactivity_treshold = float(params.get("inactivity_treshold", 1800))
@@ -1989,23 +2191,62 @@ def _take_screendumps(test, params, env):
     counter = {}
     inactivity = {}
 
+    def _convert_screendump(vm_instance, vm_name, src, dst):
+        """Convert one dumped PPM to JPEG; errors only warn."""
+        try:
+            timestamp = os.stat(src).st_ctime
+            image = PIL_Image.open(src)
+            image = ppm_utils.add_timestamp(image, timestamp)
+            image.save(dst, format="JPEG", quality=quality)
+        except (IOError, OSError) as error_detail:
+            LOG.warning(
+                "VM '%s' failed to produce a " "screendump: %s",
+                vm_name,
+                error_detail,
+            )
+            # Decrement the counter as we in fact failed to
+            # produce a converted screendump
+            counter[vm_instance] -= 1
+        finally:
+            os.unlink(src)
+
+    def _dump_screen(vm, temp_filename):
+        """Ask one VM's monitor for a screendump; errors only warn."""
+        try:
+            vm.screendump(filename=temp_filename, debug=False)
+        except qemu_monitor.MonitorError as e:
+            LOG.warn(e)
+        except AttributeError as e:
+            LOG.warn(e)
+
     while True:
+        tick_start = time.monotonic()
+        # Each VM has its own monitor socket, so the dump round-trips of a
+        # tick are independent and can be issued concurrently; the dump
+        # files are per-VM so the JPEG conversions can overlap as well
+        dump_jobs = []
         for vm in env.get_all_vms():
-            if vm.instance not in list(counter.keys()):
+            temp_filename = "scrdump-%s-%s-iter%s.ppm" % (
+                random_id,
+                vm.instance,
+                test.iteration,
+            )
+            temp_filename = os.path.join(temp_dir, temp_filename)
+            if vm.instance not in counter:
                 counter[vm.instance] = 0
-            if vm.instance not in list(inactivity.keys()):
+            if vm.instance not in inactivity:
                 inactivity[vm.instance] = time.time()
             if not vm.is_alive():
                 continue
+            dump_jobs.append((vm, temp_filename))
+        if len(dump_jobs) == 1:
+            _dump_screen(*dump_jobs[0])
+        elif dump_jobs:
+            utils_misc.parallel((_dump_screen, job) for job in dump_jobs)
+
+        convert_jobs = []
+        for vm, temp_filename in dump_jobs:
             vm_pid = vm.get_pid()
-            try:
-                vm.screendump(filename=temp_filename, debug=False)
-            except qemu_monitor.MonitorError as e:
-                LOG.warn(e)
-                continue
-            except AttributeError as e:
-                LOG.warn(e)
-                continue
             if not os.path.exists(temp_filename):
                 LOG.warn("VM '%s' failed to produce a screendump", vm.name)
                 continue
@@ -2027,7 +2268,7 @@ def _take_screendumps(test, params, env):
             filename = "%04d.jpg" % counter[vm.instance]
             screendump_filename = os.path.join(screendump_dir, filename)
             vm.verify_bsod(screendump_filename)
-            image_hash = crypto.hash_file(temp_filename)
+            image_hash = _screendump_id(temp_filename)
             if image_hash in cache:
                 time_inactive = time.time() - inactivity[vm.instance]
                 if time_inactive > inactivity_treshold:
@@ -2049,30 +2290,30 @@ def _take_screendumps(test, params, env):
             else:
                 inactivity[vm.instance] = time.time()
             cache[image_hash] = screendump_filename
-            try:
-                try:
-                    timestamp = os.stat(temp_filename).st_ctime
-                    image = PIL.Image.open(temp_filename)
-                    image = ppm_utils.add_timestamp(image, timestamp)
-                    image.save(screendump_filename, format="JPEG", quality=quality)
-                except (IOError, OSError) as error_detail:
-                    LOG.warning(
-                        "VM '%s' failed to produce a " "screendump: %s",
-                        vm.name,
-                        error_detail,
-                    )
-                    # Decrement the counter as we in fact failed to
-                    # produce a converted screendump
-                    counter[vm.instance] -= 1
-            except NameError:
-                pass
-            os.unlink(temp_filename)
+            if PIL_Image is not None:
+                convert_jobs.append(
+                    (vm.instance, vm.name, temp_filename, screendump_filename)
+                )
+            else:
+                os.unlink(temp_filename)
+
+        # The conversions are CPU/IO bound and independent, so overlap them
+        # when several VMs produced a dump in this tick
+        if len(convert_jobs) == 1:
+            _convert_screendump(*convert_jobs[0])
+        elif convert_jobs:
+            utils_misc.parallel((_convert_screendump, job) for job in convert_jobs)
 
         if _screendump_thread_termination_event is not None:
             if _screendump_thread_termination_event.is_set():
                 _screendump_thread_termination_event = None
                 break
-            _screendump_thread_termination_event.wait(delay)
+            # Account for the time spent dumping and converting so the
+            # ticks stay at a fixed rate instead of drifting by the work
+            # time; the event wait still wakes up immediately on shutdown
+            _screendump_thread_termination_event.wait(
+                max(0.0, delay - (time.monotonic() - tick_start))
+            )
         else:
             # Exit event was deleted, exit this thread
             break
@@ -2117,13 +2358,11 @@ def store_vm_info(vm, log_filename, info_cmd="registers", append=False, vmtype="
 
     log_filename = "%s_%s" % (log_filename, timestamp)
     if append:
-        vr_log = open(log_filename, "r+")
-        vr_log.seek(0, 2)
         output += "\n"
-    else:
-        vr_log = open(log_filename, "w")
-    vr_log.write(str(output))
-    vr_log.close()
+    # O_APPEND positions at EOF in the kernel, so appending is a single
+    # open+write instead of the old open("r+")/seek(end)/write triple
+    with open(log_filename, "a" if append else "w") as vr_log:
+        vr_log.write(str(output))
     return True
 
 
@@ -2141,10 +2380,17 @@ def _store_vm_info(test, params, env):
     global _vm_info_thread_termination_event
     delay = float(params.get("vm_info_delay", 5))
     cmds = params.get("vm_info_cmds", "registers").split(",")
+    vmtype = params.get("vm_type")
+    # Derived log dirs keyed on (instance, pid) so the path join and
+    # makedirs happen once per VM lifetime, not once per (cmd, VM) per tick
+    vr_dir_cache = {}
     cmd_details = {}
     for cmd in cmds:
         cmd_details.update({cmd: {"counter": {}, "vm_info_error_count": {}}})
     while True:
+        # get_pid() reads the VM pid file, so look it up once per VM and
+        # tick instead of once per (cmd, VM) pair
+        pid_cache = {}
         for cmd in cmds:
             for vm in env.get_all_vms():
                 if vm.instance not in cmd_details[cmd]["vm_info_error_count"]:
@@ -2157,14 +2403,20 @@ def _store_vm_info(test, params, env):
                         )
                     cmd_details[cmd]["vm_info_error_count"][vm.instance] += 1
                     continue
-                vm_pid = vm.get_pid()
-                vr_dir = utils_misc.get_path(
-                    test.debugdir, "vm_info_%s_%s" % (vm.name, vm_pid)
-                )
-                try:
-                    os.makedirs(vr_dir)
-                except OSError:
-                    pass
+                vm_pid = pid_cache.get(vm.instance)
+                if vm_pid is None:
+                    vm_pid = vm.get_pid()
+                    pid_cache[vm.instance] = vm_pid
+                vr_dir = vr_dir_cache.get((vm.instance, vm_pid))
+                if vr_dir is None:
+                    vr_dir = utils_misc.get_path(
+                        test.debugdir, "vm_info_%s_%s" % (vm.name, vm_pid)
+                    )
+                    try:
+                        os.makedirs(vr_dir)
+                    except OSError:
+                        pass
+                    vr_dir_cache[(vm.instance, vm_pid)] = vr_dir
 
                 if vm.instance not in cmd_details[cmd]["counter"]:
                     cmd_details[cmd]["counter"][vm.instance] = 1
@@ -2173,7 +2425,6 @@ def _store_vm_info(test, params, env):
                     cmd,
                 )
                 vr_filename = utils_misc.get_path(vr_dir, vr_filename)
-                vmtype = params.get("vm_type")
                 stored_log = store_vm_info(vm, vr_filename, cmd, vmtype=vmtype)
                 if cmd_details[cmd]["vm_info_error_count"][vm.instance] >= 1:
                     LOG.debug(
@@ -41,14 +41,24 @@ from virttest import (
 # workaround to avoid changing the entire file.
 LOG = logging.getLogger("avocado." + __name__)
 
+#: Cache of normalized connect URIs; canonicalizing spawns a virsh process
+#: and the canonical form of a given URI does not change while libvirt runs
+_normalized_uri_cache = {}
+
 
 def normalize_connect_uri(connect_uri):
     """
     Processes connect_uri Cartesian into something virsh can use
 
+    The result is cached per input URI, so repeated calls (one per VM and
+    per pre/postprocess round) reuse a single virsh round-trip.
+
     :param connect_uri: Cartesian Params setting
     :return: Normalized connect_uri
     """
+    result = _normalized_uri_cache.get(connect_uri)
+    if result:
+        return result
     if connect_uri == "default":
         result = virsh.canonical_uri()
     else:
@@ -58,6 +68,7 @@ def normalize_connect_uri(connect_uri):
         raise ValueError(
             "Normalizing connect_uri '%s' failed, is libvirt " "running?" % connect_uri
         )
+    _normalized_uri_cache[connect_uri] = result
     return result
 
 
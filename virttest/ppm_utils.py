@@ -12,6 +12,7 @@ import os
 import re
 import struct
 import time
+import zlib
 from functools import reduce
 
 try:
@@ -136,6 +137,42 @@ def image_write_to_ppm_file(filename, width, height, data):
         fout.write(data)
 
 
+def image_ppm_to_png(ppm_filename, png_filename):
+    """
+    Convert a PPM image to PNG.
+
+    The PNG file is assembled directly with zlib and struct (unfiltered
+    8-bit RGB scanlines in a single IDAT chunk), so no imaging library
+    is needed and no intermediate image object is created.
+
+    :param ppm_filename: Path of the source PPM file.
+    :param png_filename: Path of the PNG file to write.
+    """
+    (width, height, data) = image_read_from_ppm_file(ppm_filename)
+    row_bytes = width * 3
+    raw = bytearray()
+    for offset in range(0, height * row_bytes, row_bytes):
+        raw.append(0)  # filter type "None" for this scanline
+        raw += data[offset : offset + row_bytes]
+
+    def _chunk(chunk_type, payload):
+        chunk = chunk_type + payload
+        return (
+            struct.pack(">I", len(payload))
+            + chunk
+            + struct.pack(">I", zlib.crc32(chunk) & 0xFFFFFFFF)
+        )
+
+    with open(png_filename, "wb") as fout:
+        fout.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per sample, color type 2 (truecolor RGB)
+        fout.write(
+            _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        )
+        fout.write(_chunk(b"IDAT", zlib.compress(bytes(raw))))
+        fout.write(_chunk(b"IEND", b""))
+
+
 def image_crop(width, height, data, x1, y1, dx, dy):
     """
     Crop an image.
@@ -9,6 +9,7 @@ from __future__ import division
 
 import collections
 import errno
+import filecmp
 import functools
 import json
 import logging
@@ -1152,6 +1153,23 @@ class QemuImg(object):
         else:
             LOG.info("No source file %s, skipping copy...", src)
 
+    @staticmethod
+    def _clone_needed(m_image_fn, image_fn):
+        """
+        Check whether cloning the master image would change the target.
+
+        :param m_image_fn: Master image filename.
+        :param image_fn: Cloned image filename.
+        :return: False if the target exists and is bit-identical to the
+                 master, True otherwise.
+        """
+        try:
+            if os.path.getsize(m_image_fn) != os.path.getsize(image_fn):
+                return True
+            return not filecmp.cmp(m_image_fn, image_fn, shallow=False)
+        except OSError:
+            return True
+
     @staticmethod
     def clone_image(params, vm_name, image_name, root_dir):
         """
@@ -1180,7 +1198,12 @@ class QemuImg(object):
                     m_image_fn = get_image_filename(params, root_dir)
                 image_fn = get_image_filename(image_params, root_dir)
                 force_clone = params.get("force_image_clone", "no")
-                if not os.path.exists(image_fn) or force_clone == "yes":
+                need_clone = not os.path.exists(image_fn)
+                if not need_clone and force_clone == "yes":
+                    # A forced clone over a bit-identical target would just
+                    # rewrite the same data, so only redo it on a mismatch
+                    need_clone = QemuImg._clone_needed(m_image_fn, image_fn)
+                if need_clone:
                     LOG.info("Clone master image for vms.")
                     process.run(
                         params.get("image_clone_command") % (m_image_fn, image_fn)